@@ -0,0 +1,316 @@
+import asyncio
+
+from itertools import groupby, islice
+from typing import Any, List, Dict, Iterable, Tuple
+from sqlalchemy import select, MetaData, Table, text, bindparam, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from . import schema
+from .interface import _set_sqlite_pragmas, _stmt_key, _build_stmt, _stmt_params
+
+# Async drivers to swap in for the sync drivers used with DBInterface
+ASYNC_DRIVERS = {
+    'mysql': 'mysql+aiomysql',
+    'mysql+mysqlconnector': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+}
+
+class AsyncDBInterface:
+    """
+        An asyncio wrapper for sqlalchemy database connections, mirroring DBInterface.
+        Every call checks a connection out of the engine's pool, so independent
+        queries can be awaited concurrently (i.e. with asyncio.gather). Statements
+        are built and cached the same way as DBInterface's; there is no result cache
+        and no transaction(), each call runs in its own transaction.
+    Attributes:
+        engine: The AsyncEngine from sqlalchemy
+    """
+    def __init__(self, connection_string: str, connect_args: {} = {}):
+        """
+            Intialize an AsyncDBInterface object
+        Args:
+            connection_string: the sqlalchemy connection string, sync drivers are
+                               swapped for their async counterparts (see ASYNC_DRIVERS)
+        """
+        url = make_url(connection_string)
+        url = url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+        self.engine = create_async_engine(url, connect_args=connect_args, pool_recycle=3600)
+
+        self._meta = MetaData()
+        self._tables: Dict[str, Table] = {}
+        self._reflect_lock = None
+        self._stmt_cache: Dict[tuple, Any] = {}
+
+        if url.get_backend_name() == 'sqlite':
+            event.listen(self.engine.sync_engine, "connect", _set_sqlite_pragmas)
+
+    def get_engine(self):
+        """
+            Get the db engine
+        Returns:
+            A reference to the AsyncEngine from sqlalchemy
+        """
+        return self.engine
+
+    async def _reflect(self, table: str) -> Table:
+        """
+            Get a table declared in schema.metadata, or reflect it, only hitting the
+            database the first time it is requested
+        Args:
+            table: The table name, as a string
+
+        Returns:
+            The sqlalchemy Table
+        """
+        t = self._tables.get(table)
+        if t is None:
+            t = schema.metadata.tables.get(table)
+        if t is not None:
+            return t
+
+        if self._reflect_lock is None:
+            self._reflect_lock = asyncio.Lock()
+
+        async with self._reflect_lock:
+            t = self._tables.get(table)
+            if t is None:
+                async with self.engine.connect() as conn:
+                    t = await conn.run_sync(lambda sync_conn: Table(table, self._meta, autoload_with=sync_conn))
+                self._tables[table] = t
+
+        return t
+
+    def invalidate(self, table: str = None):
+        """
+            Drop cached table reflections and statements, i.e. after the schema changes
+        Args:
+            table: The table to forget, if None all tables are forgotten
+        """
+        if table is None:
+            self._tables.clear()
+            self._meta.clear()
+            self._stmt_cache.clear()
+        else:
+            if table in self._tables:
+                self._meta.remove(self._tables.pop(table))
+            for key in [key for key in self._stmt_cache if key[0] == table]:
+                del self._stmt_cache[key]
+
+    async def _where_stmt(self, table: str, kind: str, filters: dict, targets: tuple = (),
+                          values: dict = None) -> Tuple[Any, dict]:
+        """
+            Get a cached statement, see DBInterface._where_stmt
+        Args:
+            table: The table name, as a string
+            kind: One of 'select', 'insert', 'update' or 'delete'
+            filters: Column names corresponding to the values to match
+            targets: The columns to select
+            values: For inserts and updates, column names corresponding to the values to set
+
+        Returns:
+            The statement, and its bind parameters
+        """
+        key = _stmt_key(table, kind, filters, targets, values)
+
+        cached = self._stmt_cache.get(key)
+        if cached is None:
+            cached = self._stmt_cache[key] = _build_stmt(await self._reflect(table), key)
+
+        return cached[0], _stmt_params(cached, filters, values)
+
+    async def query(self, sql: str):
+        """
+            Query using plain SQL
+        Args:
+            sql: The sql, as a string
+
+        Returns:
+            A result set.
+        """
+        async with self.engine.begin() as conn:
+            result = await conn.execute(text(sql))
+
+            if result.returns_rows:
+                return result.fetchall()
+
+    async def insert_row(self, table: str, data: dict) -> int:
+        """
+            Insert one row to a table
+        Args:
+            table: The table name, as a string
+            data: The data to insert, as key-value pairs in a dict
+
+        Returns:
+            An int, the last row's id
+        """
+        t = await self._reflect(table)
+        ps, params = await self._where_stmt(table, 'insert', {},
+                                            values={key: value for key, value in data.items() if key in t.c})
+
+        async with self.engine.begin() as conn:
+            result = await conn.execute(ps, params)
+
+        return result.lastrowid
+
+    async def insert_rows(self, table: str, rows: Iterable[dict], batch_size: int = 1000) -> int:
+        """
+            Insert many rows to a table in a single transaction
+        Args:
+            table: The table name, as a string
+            rows: The rows to insert, each as key-value pairs in a dict
+            batch_size: The number of rows sent to the database per executemany
+
+        Returns:
+            An int, the number of rows inserted
+        """
+        t = await self._reflect(table)
+        ps = t.insert()
+
+        rows = iter(rows)
+        count = 0
+        async with self.engine.begin() as conn:
+            while True:
+                chunk = [{key: value for key, value in row.items() if key in t.c} for row in islice(rows, batch_size)]
+                if not chunk:
+                    break
+
+                # executemany takes its columns from the first row, so rows with other
+                # keys go in their own batch rather than losing or missing values
+                for _, group in groupby(chunk, key=dict.keys):
+                    await conn.execute(ps, list(group))
+                count += len(chunk)
+
+        return count
+
+    async def update_row(self, table, data, atomic=False, **kwargs):
+        """
+            Update a row for a given table, in its own transaction
+        Args:
+            table (): The table to insert to, as a string
+            data (): The data to update, as key-value pairs in a dict
+            atomic (): Accepted for compatibility with DBInterface; every update is
+                       already atomic, and failures are always raised
+            **kwargs: Column names corresponding to values used to match the row
+        """
+        ps, params = await self._where_stmt(table, 'update', kwargs, values=data)
+
+        async with self.engine.begin() as conn:
+            await conn.execute(ps, params)
+
+    async def aselect(self, table, col_name: str, fetch_one=True, **kwargs):
+        """
+            Select with AND for matching arguments
+        Args:
+            table (): The table to select from
+            fetch_one (): If True, will just return the first result in the set
+            col_name: The column name to select
+            **kwargs: Column names corresponding to values used to perform the query
+
+        Returns:
+            A result set.
+        """
+        ps, params = await self._where_stmt(table, 'select', kwargs, (col_name,))
+
+        async with self.engine.connect() as conn:
+            res = await conn.execute(ps, params)
+
+        if fetch_one:
+            r = res.fetchone()
+            return tuple(r) if r else None
+        else:
+            return res.fetchall()
+
+    async def aselectn(self, table, col_names: List[str], fetch_one=True, **kwargs):
+        """
+            Select with AND for matching arguments
+        Args:
+            table (): The table to select from
+            fetch_one (): If True, will just return the first result in the set
+            col_names: The column names to select
+            **kwargs: Column names corresponding to values used to perform the query
+
+        Returns:
+            A result set.
+        """
+        ps, params = await self._where_stmt(table, 'select', kwargs, tuple(col_names))
+
+        async with self.engine.connect() as conn:
+            res = await conn.execute(ps, params)
+
+        if fetch_one:
+            r = res.fetchone()
+            return tuple(r) if r else None
+        else:
+            return res.fetchall()
+
+    async def aselect_many(self, table, col_name: str, key_col: str, keys: Iterable) -> dict:
+        """
+            Select one column for many keys in a single round trip
+        Args:
+            table (): The table to select from
+            col_name: The column name to select
+            key_col: The column name to match keys against
+            keys: The values of key_col to look up
+
+        Returns:
+            A dict mapping each key found to its col_name value.
+        """
+        t = await self._reflect(table)
+        ps = select(t.c[key_col], t.c[col_name]).where(t.c[key_col].in_(bindparam('keys', expanding=True)))
+
+        async with self.engine.connect() as conn:
+            res = await conn.execute(ps, {'keys': list(keys)})
+
+        return dict(res.fetchall())
+
+    async def select_all(self, table):
+        """
+            Select all rows from a table
+        Args:
+            table (): The table to select from
+
+        Returns:
+            A result set.
+        """
+        t = await self._reflect(table)
+        ps = select(t)
+
+        async with self.engine.connect() as conn:
+            res = await conn.execute(ps)
+
+        return res.fetchall()
+
+    async def remove(self, table, column_name, column_value):
+        """
+            Remove from a table where one column_name matches
+        Args:
+            table (): The table to remove from
+            column_name (): The column_name to match
+            column_value (): The column_value to match
+        """
+        ps, params = await self._where_stmt(table, 'delete', {column_name: column_value})
+
+        async with self.engine.begin() as conn:
+            await conn.execute(ps, params)
+
+    async def removen(self, table, **kwargs):
+        """
+            Remove from a table where multiple columns match
+        Args:
+            table (): The table to remove from
+            **kwargs: The columns to match
+        """
+        ps, params = await self._where_stmt(table, 'delete', kwargs)
+
+        async with self.engine.begin() as conn:
+            await conn.execute(ps, params)
+
+    async def close(self):
+        """
+            Close every pooled connection.
+        """
+        await self.engine.dispose()
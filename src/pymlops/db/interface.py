@@ -1,38 +1,58 @@
-import sys
-
-from typing import List, Dict
-from sqlalchemy import create_engine, select, delete, Column, Integer, String, MetaData, Table, and_, text
+import logging
+import threading
+
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from itertools import groupby, islice
+from typing import Any, List, Dict, Iterable, Iterator, Tuple
+from sqlalchemy import create_engine, select, delete, Column, Integer, String, MetaData, Table, and_, text, bindparam, event, tuple_
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.exc import OperationalError, IntegrityError, SQLAlchemyError
 
+from . import schema
+
+logger = logging.getLogger(__name__)
+
 class DBInterface:
     """
         A wrapper for sqlalchemy database connections.
+        Every call checks a connection out of the engine's pool, so one instance
+        can be shared between threads. Writes are autocommitted; use transaction()
+        to group several writes into a single commit. With cache_size > 0, reads from
+        aselect, aselectn and select_all are cached until this instance writes to the
+        table they read from; writes by other processes or instances are not seen, so
+        only enable the cache when this instance is the tables' only writer.
     Attributes: 
         engine: The engine from sqlalchemy
     """
-    def __init__(self, connection_string: str, connect_args: {} = {}):
+    def __init__(self, connection_string: str, connect_args: {} = {}, cache_size: int = 0):
         """
             Intialize a DBInterface object
         Args:
             connection_string: the sqlalchemy connection string
+            cache_size: the number of read results to keep cached, 0 (the default) disables the cache
         """
-        self.engine = create_engine(connection_string, connect_args=connect_args, pool_recycle=3600)
+        # SQLite's in-memory databases use a SingletonThreadPool, which can't be sized
+        pool_args = {} if 'sqlite' in connection_string else {'pool_size': 10, 'max_overflow': 20}
 
-        if self.engine is not None:
-            self.connection = self.engine.connect()
+        self.engine = create_engine(connection_string, connect_args=connect_args, pool_recycle=3600,
+                                    pool_pre_ping=True, isolation_level="AUTOCOMMIT", **pool_args)
 
-        if 'sqlite' in connection_string:
-            raw_conn = self.connection.connection
-            cursor = raw_conn.cursor()
+        self._meta = MetaData()
+        self._tables: Dict[str, Table] = {}
+        self._stmt_cache: Dict[tuple, Any] = {}
+        self._reflect_lock = threading.Lock()
+        self._local = threading.local()
 
-            cursor.execute("PRAGMA journal_mode=WAL;")
-            cursor.execute("PRAGMA synchronous=NORMAL;")
-            cursor.execute("PRAGMA wal_autocheckpoint=1000")
-            cursor.execute("PRAGMA foreign_keys=ON;")
+        self._qcache = OrderedDict()
+        self._qcache_by_table = defaultdict(set)
+        self._qcache_size = cache_size
+        self._qcache_gen = 0
+        self._qcache_lock = threading.Lock()
 
-            cursor.close()
+        if 'sqlite' in connection_string:
+            event.listen(self.engine, "connect", _set_sqlite_pragmas)
 
     def get_engine(self):
         """
@@ -42,19 +62,214 @@ class DBInterface:
         """
         return self.engine
 
-    def query(self, sql: str):
+    @contextmanager
+    def transaction(self):
+        """
+            Group writes into a single transaction, committed when the block exits
+            and rolled back if it raises. Nested calls join the outer transaction.
+
+        Yields:
+            This DBInterface
+        """
+        if getattr(self._local, 'connection', None) is not None:
+            yield self
+            return
+
+        # begin() is a no-op for the DBAPI under AUTOCOMMIT, so drop back to the
+        # dialect's default isolation level; the pool restores AUTOCOMMIT on checkin.
+        # SQLite instead takes the write lock up front, so a block that reads before it
+        # writes waits for other writers rather than failing with SQLITE_BUSY under WAL
+        with self.engine.connect() as conn:
+            sqlite = conn.dialect.name == 'sqlite'
+            if not sqlite:
+                conn.execution_options(isolation_level=conn.default_isolation_level)
+
+            # cached reads of tables written here are dropped again once the writes are
+            # visible, as other threads may have cached them before the commit
+            self._local.dirty = set()
+            try:
+                with conn.begin():
+                    if sqlite:
+                        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+                    self._local.connection = conn
+                    try:
+                        yield self
+                    finally:
+                        self._local.connection = None
+            finally:
+                dirty, self._local.dirty = self._local.dirty, None
+                for table in dirty:
+                    self._invalidate_results(table)
+
+    @contextmanager
+    def _connect(self):
+        """
+            Get the connection of this thread's open transaction, or a pooled one
+
+        Yields:
+            A sqlalchemy Connection
+        """
+        conn = getattr(self._local, 'connection', None)
+        if conn is not None:
+            yield conn
+        else:
+            with self.engine.connect() as conn:
+                yield conn
+
+    def _reflect(self, table: str) -> Table:
+        """
+            Get a table declared in schema.metadata, or reflect it, only hitting the
+            database the first time it is requested
+        Args:
+            table: The table name, as a string
+
+        Returns:
+            The sqlalchemy Table
+        """
+        t = self._tables.get(table)
+        if t is None:
+            t = schema.metadata.tables.get(table)
+        if t is not None:
+            return t
+
+        with self._reflect_lock:
+            t = self._tables.get(table)
+            if t is None:
+                t = Table(table, self._meta, autoload_with=self.engine)
+                self._tables[table] = t
+
+        return t
+
+    def invalidate(self, table: str = None):
+        """
+            Drop cached table reflections and results, i.e. after the schema changes
+        Args:
+            table: The table to forget, if None all tables are forgotten
+        """
+        with self._reflect_lock:
+            if table is None:
+                self._tables.clear()
+                self._meta.clear()
+                self._stmt_cache.clear()
+            else:
+                if table in self._tables:
+                    self._meta.remove(self._tables.pop(table))
+                for key in [key for key in self._stmt_cache if key[0] == table]:
+                    del self._stmt_cache[key]
+
+        self._invalidate_results(table)
+
+    def _where_stmt(self, table: str, kind: str, filters: dict, targets: tuple = (),
+                    values: dict = None) -> Tuple[Any, dict]:
+        """
+            Get a statement matching every column in filters, built once per shape and
+            then reused with the filter and update values passed as bind parameters
+        Args:
+            table: The table name, as a string
+            kind: One of 'select', 'insert', 'update' or 'delete'
+            filters: Column names corresponding to the values to match
+            targets: The columns to select
+            values: For inserts and updates, column names corresponding to the values to set
+
+        Returns:
+            The statement, and its bind parameters
+        """
+        key = _stmt_key(table, kind, filters, targets, values)
+
+        cached = self._stmt_cache.get(key)
+        if cached is None:
+            cached = self._stmt_cache[key] = _build_stmt(self._reflect(table), key)
+
+        return cached[0], _stmt_params(cached, filters, values)
+
+    def _cached(self, key: tuple, fetch):
+        """
+            Serve a read from the result cache, running it on a miss. Reads inside a
+            transaction bypass the cache, as they may see uncommitted writes.
+        Args:
+            key: A hashable key for the read, starting with the table it reads from
+            fetch: A callable running the read
+
+        Returns:
+            The result of fetch()
+        """
+        if self._qcache_size <= 0 or getattr(self._local, 'connection', None) is not None:
+            return fetch()
+
+        try:
+            hash(key)
+        except TypeError:
+            return fetch()
+
+        with self._qcache_lock:
+            if key in self._qcache:
+                self._qcache.move_to_end(key)
+                return _copy_result(self._qcache[key])
+            gen = self._qcache_gen
+
+        value = fetch()
+
+        # a write since the read began may have made the value stale
+        with self._qcache_lock:
+            if gen == self._qcache_gen:
+                self._qcache[key] = value
+                self._qcache_by_table[key[0]].add(key)
+
+                while len(self._qcache) > self._qcache_size:
+                    old, _ = self._qcache.popitem(last=False)
+                    self._qcache_by_table[old[0]].discard(old)
+
+        return _copy_result(value)
+
+    def _invalidate_results(self, table: str = None):
+        """
+            Drop cached reads of a table, along with any cached plain SQL results
+        Args:
+            table: The table written to, if None the whole cache is dropped
+        """
+        dirty = getattr(self._local, 'dirty', None)
+        if dirty is not None:
+            dirty.add(table)
+
+        with self._qcache_lock:
+            self._qcache_gen += 1
+
+            if table is None:
+                self._qcache.clear()
+                self._qcache_by_table.clear()
+                return
+
+            for key in self._qcache_by_table.pop(table, set()) | self._qcache_by_table.pop(None, set()):
+                self._qcache.pop(key, None)
+
+    def query(self, sql: str, cache: bool = False):
         """
             Query using plain SQL
         Args:
             sql: The sql, as a string
+            cache: If True, the result may be served from and stored in the result cache;
+                   only pass it for read-only queries
 
         Returns:
             A result set.
         """
-        result = self.connection.execute(text(sql))
+        def fetch():
+            with self._connect() as conn:
+                result = conn.execute(text(sql))
+                rows = result.fetchall() if result.returns_rows else None
+
+            # we can't tell what plain SQL touched, and returning rows doesn't make it
+            # a read (i.e. UPDATE ... RETURNING), so only trust queries marked cacheable
+            if not cache or rows is None:
+                self._invalidate_results()
+
+            return rows
+
+        if cache:
+            return self._cached((None, sql), fetch)
 
-        if result and hasattr(result, "fetchall"):
-            return result.fetchall()
+        return fetch()
 
     def prepare_insertion(self, table: str, data: dict):
         """
@@ -66,7 +281,7 @@ class DBInterface:
         Returns:
             A prepared statement
         """
-        t = Table(table, MetaData(), autoload_with=self.engine)
+        t = self._reflect(table)
         ps = t.insert().values(
              **{key: value for key, value in data.items() if key in t.c}
         )
@@ -83,12 +298,93 @@ class DBInterface:
         Returns:
             An int, the last row's id
         """
-        ps = self.prepare_insertion(table, data)
+        t = self._reflect(table)
+        ps, params = self._where_stmt(table, 'insert', {},
+                                      values={key: value for key, value in data.items() if key in t.c})
 
-        result = self.connection.execute(ps)
-        self.connection.commit()
+        with self._connect() as conn:
+            result = conn.execute(ps, params)
+            self._invalidate_results(table)
+
+            return result.lastrowid
+
+    def insert_rows(self, table: str, rows: Iterable[dict], batch_size: int = 1000) -> int:
+        """
+            Insert many rows to a table in a single transaction
+        Args:
+            table: The table name, as a string
+            rows: The rows to insert, each as key-value pairs in a dict
+            batch_size: The number of rows sent to the database per executemany
+
+        Returns:
+            An int, the number of rows inserted
+        """
+        t = self._reflect(table)
+        ps = t.insert()
 
-        return result.lastrowid
+        rows = iter(rows)
+        count = 0
+        with self.transaction(), self._connect() as conn:
+            sqlite = conn.dialect.name == 'sqlite'
+
+            while True:
+                chunk = [{key: value for key, value in row.items() if key in t.c} for row in islice(rows, batch_size)]
+                if not chunk:
+                    break
+
+                # executemany takes its columns from the first row, so rows with other
+                # keys go in their own batch rather than losing or missing values
+                for _, group in groupby(chunk, key=dict.keys):
+                    group = list(group)
+                    if not (sqlite and self._sqlite_bulk_insert(conn, t, group)):
+                        conn.execute(ps, group)
+                count += len(chunk)
+
+            self._invalidate_results(table)
+
+        return count
+
+    def _sqlite_bulk_insert(self, conn, t: Table, chunk: List[dict]) -> bool:
+        """
+            Insert rows with the sqlite3 cursor's executemany, skipping sqlalchemy's
+            per-row statement and parameter bookkeeping. Values are still converted by
+            the columns' bind processors. Only chunks that leave out no column with a
+            python side default are inserted.
+        Args:
+            conn: The connection of the open transaction
+            t: The table to insert to
+            chunk: The rows to insert, all with the same keys
+
+        Returns:
+            True if the rows were inserted
+        """
+        keys = chunk[0].keys()
+        if not keys:
+            return False
+
+        # sqlalchemy fills these in itself, the database knows nothing of them
+        if any(col.default is not None for col in t.c if col.key not in keys):
+            return False
+
+        dialect = conn.dialect
+        processors = [(key, t.c[key].type.dialect_impl(dialect).bind_processor(dialect)) for key in keys]
+        params = [tuple(row[key] if process is None else process(row[key]) for key, process in processors)
+                  for row in chunk]
+
+        preparer = dialect.identifier_preparer
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(
+            preparer.format_table(t),
+            ", ".join(preparer.quote(t.c[key].name) for key in keys),
+            ", ".join("?" for _ in keys)
+        )
+
+        cursor = conn.connection.cursor()
+        try:
+            cursor.executemany(sql, params)
+        finally:
+            cursor.close()
+
+        return True
 
     def update_row(self, table, data, atomic=False, **kwargs):
         """
@@ -96,28 +392,27 @@ class DBInterface:
         Args:
             table (): The table to insert to, as a string
             data (): The data to update, as key-value pairs in a dict
-            atomic (): If True, will update the row as an atomic transaction
+            atomic (): If True, will update the row as an atomic transaction, logging
+                       failures; inside transaction() failures are raised instead
             **kwargs: 
         """
-        t = Table(table, MetaData(), autoload_with=self.engine)
-
-        conditions = []
-        for key, value in kwargs.items():
-            conditions.append(getattr(t.c, key) == value)
-
-        ps = t.update().values(data).where(and_(*conditions))
+        ps, params = self._where_stmt(table, 'update', kwargs, values=data)
 
         if atomic:
+            joined = getattr(self._local, 'connection', None) is not None
             try:
-                self.connection.execute(text("BEGIN EXCLUSIVE"))
-                self.connection.execute(ps)
-                self.connection.commit()
-            except Exception as e:
-                print("Caught", e, file=sys.stderr)
-                self.connection.rollback()
+                with self.transaction(), self._connect() as conn:
+                    conn.execute(ps, params)
+                    self._invalidate_results(table)
+            except SQLAlchemyError:
+                # swallowing this would let the caller's transaction commit around it
+                if joined:
+                    raise
+                logger.exception("update_row failed for table=%s", table)
         else:
-            self.connection.execute(ps)
-            self.connection.commit()
+            with self._connect() as conn:
+                conn.execute(ps, params)
+                self._invalidate_results(table)
 
     def aselect(self, table, col_name: str, fetch_one=True, **kwargs):
         """
@@ -131,22 +426,19 @@ class DBInterface:
         Returns:
             A result set.
         """
-        t = Table(table, MetaData(), autoload_with=self.engine)
-        conditions = []
-        for key, value in kwargs.items():
-            conditions.append(getattr(t.c, key) == value)
+        def fetch():
+            ps, params = self._where_stmt(table, 'select', kwargs, (col_name,))
 
-        col = getattr(t.c, col_name)
-        ps = select(col).where(and_(*conditions))
+            with self._connect() as conn:
+                res = conn.execute(ps, params)
 
-        compiled = ps.compile(self.engine, compile_kwargs={"literal_binds": True})
-        res = self.connection.execute(compiled)
+                if fetch_one:
+                    r = res.first()
+                    return tuple(r) if r else None
+                else:
+                    return res.fetchall()
 
-        if fetch_one:
-            r = res.fetchone()
-            return tuple(r) if r else None
-        else:
-            return res.fetchall()
+        return self._cached((table, 'aselect', col_name, fetch_one, tuple(sorted(kwargs.items()))), fetch)
 
     def aselectn(self, table, col_names: List[str], fetch_one=True, *args, **kwargs):
         """
@@ -160,21 +452,37 @@ class DBInterface:
         Returns:
             A result set.
         """
-        t = Table(table, MetaData(), autoload_with=self.engine)
-        conditions = []
-        for key, value in kwargs.items():
-            conditions.append(getattr(t.c, key) == value)
+        def fetch():
+            ps, params = self._where_stmt(table, 'select', kwargs, tuple(col_names))
 
-        cols = [getattr(t.c, col_name) for col_name in col_names]
-        ps = select(*cols).where(and_(*conditions))
+            with self._connect() as conn:
+                res = conn.execute(ps, params)
 
-        compiled = ps.compile(self.engine, compile_kwargs={"literal_binds": True})
-        res = self.connection.execute(compiled)
+                if fetch_one:
+                    return tuple(res.first())
+                else:
+                    return res.fetchall()
 
-        if fetch_one:
-            return tuple(res.fetchone())
-        else:
-            return res.fetchall()
+        return self._cached((table, 'aselectn', tuple(col_names), fetch_one, tuple(sorted(kwargs.items()))), fetch)
+
+    def aselect_many(self, table, col_name: str, key_col: str, keys: Iterable) -> dict:
+        """
+            Select one column for many keys in a single round trip
+        Args:
+            table (): The table to select from
+            col_name: The column name to select
+            key_col: The column name to match keys against
+            keys: The values of key_col to look up
+
+        Returns:
+            A dict mapping each key found to its col_name value.
+        """
+        t = self._reflect(table)
+        ps = select(t.c[key_col], t.c[col_name]).where(t.c[key_col].in_(bindparam('keys', expanding=True)))
+
+        with self._connect() as conn:
+            res = conn.execute(ps, {'keys': list(keys)})
+            return dict(res.fetchall())
 
     def select_all(self, table):
         """
@@ -185,11 +493,55 @@ class DBInterface:
         Returns:
             A result set.
         """
-        t = Table(table, MetaData(), autoload_with=self.engine)
-        ps = select(t).where()
+        def fetch():
+            t = self._reflect(table)
+            ps = select(t).where()
+
+            with self._connect() as conn:
+                res = conn.execute(ps)
+                return res.fetchall()
+
+        return self._cached((table, 'select_all'), fetch)
 
-        res = self.connection.execute(ps)
-        return res.fetchall()
+    def iter_all(self, table, chunk: int = 10_000) -> Iterator:
+        """
+            Stream all rows from a table, buffering at most chunk rows at a time.
+            The connection is held until the iterator is exhausted or closed.
+
+            Drivers without server side cursors (i.e. mysql-connector, which buffers
+            whole result sets) are paged through with one query per chunk, ordered by
+            the primary key, so rows come back in key order and concurrent writes may
+            show up part way through. Tables without a primary key can't be paged, and
+            are buffered whole on such drivers.
+        Args:
+            table (): The table to select from
+            chunk (): The number of rows fetched from the server per round trip
+
+        Returns:
+            An iterator over the rows.
+        """
+        t = self._reflect(table)
+        pk = list(t.primary_key.columns)
+
+        with self._connect() as conn:
+            # sqlite3 steps through results lazily without server side cursors
+            dialect = conn.dialect
+            if dialect.supports_server_side_cursors or dialect.name == 'sqlite' or not pk:
+                for row in conn.execute(select(t).execution_options(yield_per=chunk)):
+                    yield row
+                return
+
+            key = pk[0] if len(pk) == 1 else tuple_(*pk)
+            ps = select(t).order_by(*pk).limit(chunk)
+            page = conn.execute(ps).fetchall()
+            while page:
+                yield from page
+                if len(page) < chunk:
+                    break
+
+                last = page[-1]
+                last = last._mapping[pk[0]] if len(pk) == 1 else tuple_(*(last._mapping[col] for col in pk))
+                page = conn.execute(ps.where(key > last)).fetchall()
 
     def remove(self, table, column_name, column_value):
         """
@@ -199,11 +551,11 @@ class DBInterface:
             column_name (): The column_name to match
             column_value (): The column_value to match
         """
-        t = Table(table, MetaData(), autoload_with=self.engine)
-        ps = delete(t).where(getattr(t.c, column_name) == column_value)
+        ps, params = self._where_stmt(table, 'delete', {column_name: column_value})
 
-        self.connection.execute(ps)
-        self.connection.commit()
+        with self._connect() as conn:
+            conn.execute(ps, params)
+            self._invalidate_results(table)
 
     def removen(self, table, **kwargs):
         """
@@ -212,19 +564,91 @@ class DBInterface:
             table (): The table to remove from
             **kwargs: The columns to match
         """
-        t = Table(table, MetaData(), autoload_with=self.engine)
-
-        conditions = []
-        for key, value in kwargs.items():
-            conditions.append(getattr(t.c, key) == value)
-
-        ps = delete(t).where(and_(*conditions))
+        ps, params = self._where_stmt(table, 'delete', kwargs)
 
-        self.connection.execute(ps)
-        self.connection.commit()
+        with self._connect() as conn:
+            conn.execute(ps, params)
+            self._invalidate_results(table)
 
     def close(self):
         """
-            Close the connection.
+            Close every pooled connection.
         """
-        self.connection.close()
+        self.engine.dispose()
+
+def _stmt_key(table: str, kind: str, filters: dict, targets: tuple = (), values: dict = None) -> tuple:
+    """
+        The statement cache key for a call, see DBInterface._where_stmt
+    """
+    if kind in ('insert', 'update'):
+        targets = tuple(sorted(values))
+
+    cols = tuple(sorted(filters))
+    nulls = frozenset(key for key in cols if filters[key] is None)
+    return (table, kind, cols, nulls, targets)
+
+def _build_stmt(t: Table, key: tuple) -> tuple:
+    """
+        Build the statement for a key from _stmt_key, with its bind name prefixes
+    """
+    _, kind, cols, nulls, targets = key
+
+    # bind names matching a column are reserved by sqlalchemy in inserts and updates
+    where_prefix = _bind_prefix(t, 'w_')
+    value_prefix = _bind_prefix(t, 'v_')
+
+    conditions = [t.c[col].is_(None) if col in nulls else t.c[col] == bindparam(where_prefix + col)
+                  for col in cols]
+
+    if kind == 'select':
+        ps = select(*(t.c[col] for col in targets))
+    elif kind == 'insert':
+        ps = t.insert().values({col: bindparam(value_prefix + col) for col in targets})
+    elif kind == 'update':
+        ps = t.update().values({col: bindparam(value_prefix + col) for col in targets})
+    else:
+        ps = delete(t)
+
+    if conditions:
+        ps = ps.where(and_(*conditions))
+
+    return ps, where_prefix, value_prefix
+
+def _stmt_params(cached: tuple, filters: dict, values: dict = None) -> dict:
+    """
+        The bind parameters for a statement from _build_stmt
+    """
+    _, where_prefix, value_prefix = cached
+    params = {where_prefix + col: value for col, value in filters.items() if value is not None}
+    if values:
+        params.update({value_prefix + col: value for col, value in values.items()})
+
+    return params
+
+def _bind_prefix(t: Table, prefix: str) -> str:
+    """
+        Lengthen prefix until no column of t starts with it
+    """
+    while any(col.key.startswith(prefix) for col in t.c):
+        prefix = '_' + prefix
+
+    return prefix
+
+def _copy_result(value):
+    """
+        Copy a cached result set, so callers can't modify the cache through it
+    """
+    return list(value) if isinstance(value, list) else value
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+        Apply our SQLite settings to every new pooled connection
+    """
+    cursor = dbapi_connection.cursor()
+
+    cursor.execute("PRAGMA journal_mode=WAL;")
+    cursor.execute("PRAGMA synchronous=NORMAL;")
+    cursor.execute("PRAGMA wal_autocheckpoint=1000")
+    cursor.execute("PRAGMA foreign_keys=ON;")
+
+    cursor.close()
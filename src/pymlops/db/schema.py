@@ -0,0 +1,13 @@
+from sqlalchemy import MetaData
+
+# Tables declared on this MetaData are used as-is by DBInterface and
+# AsyncDBInterface instead of being reflected from the database, i.e.
+#
+#   Table('Training_History', metadata,
+#         Column('id', Integer, primary_key=True),
+#         Column('step', Integer),
+#         Column('loss', Float))
+#
+# Only declare tables whose schema is known to match the database; columns
+# missing from a declaration are silently dropped from insertions.
+metadata = MetaData()
@@ -6,6 +6,11 @@ import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+try:
+    import connectorx as cx
+except ImportError:
+    cx = None
+
 from db.interface import DBInterface
 
 # DB_FILE = '/Users/aidan/mnt/ab_data/ngafid/benchmarks.db'
@@ -31,12 +36,20 @@ def main():
     cols = f'{args.ordinal},'
     cols = cols + ','.join(args.metrics)
     sql = f'SELECT {cols} FROM {args.table} WHERE {args.where}'
-    df = pd.read_sql(sql, con=db.get_engine())
-
-    df_melted = df.melt(id_vars=args.ordinal, var_name='metrics', value_name='value')
-
-    sns.lineplot(data=df_melted, x=args.ordinal, y='value', hue='metrics')
-    # plt.xticks(range(df_melted[args.ordinal].min(), df_melted[args.ordinal].max() + 1, 1))
+    if cx is not None:
+        # connectorx reads straight into Arrow, but wants the URL without the sqlalchemy driver
+        url = db.get_engine().url
+        url = url.set(drivername=url.get_backend_name()).render_as_string(hide_password=False)
+        df = cx.read_sql(url, sql, return_type="arrow").to_pandas(types_mapper=pd.ArrowDtype)
+    else:
+        df = pd.read_sql(sql, con=db.get_engine(), dtype_backend="pyarrow")
+
+    ax = plt.gca()
+    for metric in args.metrics:
+        sns.lineplot(data=df, x=args.ordinal, y=metric, label=metric, ax=ax)
+    ax.set_ylabel('value')
+    ax.legend(title='metrics')
+    # plt.xticks(range(df[args.ordinal].min(), df[args.ordinal].max() + 1, 1))
     plt.title(args.title)
 
     if args.save_loc is None:
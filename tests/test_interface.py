@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+from sqlalchemy import Column, Float, Integer, Table
+
+from pymlops.db import schema
+from pymlops.db.interface import DBInterface
+
+
+ORDERS = [
+    [{'a': 1}, {'a': 3, 'b': 4}],
+    [{'a': 3, 'b': 4}, {'a': 1}],
+]
+
+
+def make_db(path):
+    db = DBInterface("sqlite:///{}".format(path))
+    db.query("CREATE TABLE kk (id INTEGER PRIMARY KEY, a INTEGER, b INTEGER)")
+    return db
+
+
+@pytest.mark.parametrize("rows", ORDERS)
+def test_insert_rows_mixed_keys(tmp_path, rows):
+    db = make_db(tmp_path / "rows.db")
+    assert db.insert_rows('kk', rows) == 2
+
+    expected = make_db(tmp_path / "row.db")
+    for row in rows:
+        expected.insert_row('kk', row)
+
+    assert db.select_all('kk') == expected.select_all('kk')
+    assert sorted(tuple(r)[1:] for r in db.select_all('kk')) == [(1, None), (3, 4)]
+
+    db.close()
+    expected.close()
+
+
+@pytest.mark.parametrize("rows", ORDERS)
+def test_async_insert_rows_mixed_keys(tmp_path, rows):
+    pytest.importorskip("aiosqlite")
+    from pymlops.db.async_interface import AsyncDBInterface
+
+    path = tmp_path / "async.db"
+    make_db(path).close()
+
+    async def run():
+        db = AsyncDBInterface("sqlite:///{}".format(path))
+        try:
+            assert await db.insert_rows('kk', rows) == 2
+            return await db.select_all('kk')
+        finally:
+            await db.close()
+
+    result = asyncio.run(run())
+    assert sorted(tuple(r)[1:] for r in result) == [(1, None), (3, 4)]
+
+
+def test_insert_rows_column_key_differs_from_name(tmp_path):
+    t = Table('keyed', schema.metadata,
+              Column('id', Integer, primary_key=True),
+              Column('Loss Value', Float, key='loss'))
+    try:
+        db = DBInterface("sqlite:///{}".format(tmp_path / "keyed.db"))
+        schema.metadata.create_all(db.get_engine(), tables=[t])
+
+        assert db.insert_rows('keyed', [{'loss': 0.5}, {'loss': 0.25}]) == 2
+        assert [tuple(r) for r in db.select_all('keyed')] == [(1, 0.5), (2, 0.25)]
+        db.close()
+    finally:
+        schema.metadata.remove(t)